@@ -1,18 +1,42 @@
 
 import math
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from gql import gql, Client
-from gql.transport.requests import RequestsHTTPTransport
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
-from queries import pool_query, tick_query, volume_query
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, it only speeds up decoding of subgraph responses
+    from json import loads as json_loads
+
+from gql import gql, Client, GraphQLRequest
+from gql.client import SyncClientSession
+from gql.transport.exceptions import TransportConnectionFailed, TransportQueryError, TransportServerError
+from gql.transport.httpx import HTTPXTransport
+
+from queries import pool_volume_query, tick_query
+
+# Parse the queries once rather than on every request
+_POOL_VOLUME_QUERY = gql(pool_volume_query)
+_TICK_QUERY = gql(tick_query)
 
 
 POOL_ID = '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8'  # 0.3% USDC/ETH pool
 # POOL_ID = '0x99ac8ca7087fa4a2a1fb6357269965a2014abc35'  # 0.3% WBTC/USDC pool
 
+_SQRT_365 = math.sqrt(365.0)  # Annualization factor of daily volatility
+
 STABLECOIN_S = {"USDC", "DAI", "USDT", "TUSD", "LUSD", "BUSD", "GUSD", "UST"}
 TICK_BASE = 1.0001
+MIN_TICK = -887272  # Cf. TickMath.sol
+
+TICK_PAGE_SIZE = 1000  # Max number of entities returned by the subgraph per query
+TICK_QUERY_WORKERS = 8  # Number of tick pages fetched concurrently
+
+QUERY_TIMEOUT = 10  # Timeout of a subgraph request, in seconds
+QUERY_MAX_TRIES = 5  # Max number of attempts of a subgraph query
 
 
 def get_annualized_implied_volatility(gamma: float, daily_volume: float, tick_liquidity: float) -> float:
@@ -25,47 +49,81 @@ def get_annualized_implied_volatility(gamma: float, daily_volume: float, tick_li
     :return: float, implied volatility
     """
 
-    return 2 * gamma * math.sqrt(daily_volume/tick_liquidity) * math.sqrt(365)
+    return 2.0 * gamma * math.sqrt(daily_volume / tick_liquidity) * _SQRT_365
 
 
-def get_usd_volume(client: Client, pool_id: str, date: datetime.date) -> float:
+def is_retryable_error(e: BaseException) -> bool:
     """
-    Get USD traded volume on a given date
-    :param client: GQL client
-    :param pool_id: str, the ID ("contract address") of the pool
-    :param date: datetime.date, a date
-    :return: float, the USD volume
+    Tell whether a failed subgraph query is worth retrying: request timeouts, server errors and indexer errors
+    :param e: the exception raised by the query
+    :return: bool, True if the query should be retried
     """
-    volume_usd = 0
-    try:
-        # See https://github.com/Uniswap/v3-subgraph/blob/main/schema.graphql for the way to build the id
-        date_dt = datetime.datetime.combine(date, datetime.time(0, 0))
-        pool_date_id = f'{pool_id}-{round(date_dt.timestamp()/86400)}'
-        response = client.execute(gql(volume_query), variable_values={"id": pool_date_id})
-        volume_usd = float(response['poolDayDatas'][0]['volumeUSD'])
+    if isinstance(e, TransportServerError):
+        return e.code is not None and e.code >= 500
 
-    except Exception as e:
+    # Unavailable indexers are transient, but a query error such as a bad argument fails the same way every time
+    if isinstance(e, TransportQueryError):
+        return 'indexer' in str(e).lower()
 
-        print(f'Could not fetch pool volume: {e}')
+    # The HTTPX transport wraps every httpx error, timeouts included, into TransportConnectionFailed
+    return isinstance(e, TransportConnectionFailed) and isinstance(e.__cause__, httpx.TimeoutException)
 
-    return volume_usd
+
+@retry(retry=retry_if_exception(is_retryable_error), wait=wait_random_exponential(multiplier=0.5, max=4),
+       stop=stop_after_attempt(QUERY_MAX_TRIES), reraise=True)
+def execute_query(client, query: GraphQLRequest, variable_values: dict) -> dict:
+    """
+    Execute a GraphQL query, retrying with jittered exponential backoff on transient errors
+    :param client: GQL client or session
+    :param query: GraphQLRequest, the parsed query, left untouched so that it can be shared between threads
+    :param variable_values: dict, the query variables
+    :return: dict, the query result
+    """
+    return client.execute(GraphQLRequest(query, variable_values=variable_values))
+
+
+def get_pool_day_id(pool_id: str, date: datetime.date) -> str:
+    """
+    Build the ID of the PoolDayData entity of a pool on a given date
+    :param pool_id: str, the ID ("contract address") of the pool
+    :param date: datetime.date, a date
+    :return: str, the PoolDayData ID
+    """
+    # See https://github.com/Uniswap/v3-subgraph/blob/main/schema.graphql for the way to build the id
+    date_dt = datetime.datetime.combine(date, datetime.time(0, 0))
+    return f'{pool_id}-{round(date_dt.timestamp()/86400)}'
 
 
 # The following functions are mostly taken from the following file, with minor edits:
 # https://github.com/atiselsts/uniswap-v3-liquidity-math/blob/master/subgraph-liquidity-range-example.py
 
+_TICK_SPACING = {
+    100: 1,
+    500: 10,
+    3000: 60,
+    10000: 200
+}
+
+
 def fee_tier_to_tick_spacing(fee_tier: int) -> int:
     """
     Return tick spacing based on fee tier
     :param fee_tier: int
     :return: int, tick spacing
     """
-    return {
-        100: 1,
-        500: 10,
-        3000: 60,
-        10000: 200
-    }.get(fee_tier, 60)
+    return _TICK_SPACING.get(fee_tier, 60)
+
+
+def get_range_bottom_tick(tick: int, tick_spacing: int) -> int:
+    """
+    Return the bottom tick of the tick range (of width tick spacing) containing a tick
+    :param tick: int, a Uni-v3 tick
+    :param tick_spacing: int, tick spacing of the pool
+    :return: int, the bottom tick of the range
+    """
+    # This code would work as well in Python: `tick // tick_spacing * tick_spacing`
+    # However, using floor() is more portable.
+    return math.floor(tick / tick_spacing) * tick_spacing
 
 
 def tick_to_price(tick: int) -> float:
@@ -77,76 +135,137 @@ def tick_to_price(tick: int) -> float:
     return TICK_BASE ** tick
 
 
-def get_pool_info(client: Client, pool_id: str) -> dict:
+def parse_pool_info(pool: dict) -> dict:
     """
-    Query the UniV3 subgraph for pool info (tokens/decimals/current tick/tick spacing)
-    :param client: GQL client
-    :param pool_id: str, the pool contract's address
+    Extract pool info (tokens/decimals/current tick/tick spacing) from a `pools` item of a subgraph response
+    :param pool: dict, a pool as returned by the UniV3 subgraph
     :return: dict, containing the pool info
     """
 
+    return {
+        'current_tick': int(pool["tick"]),
+        'fee_tier': int(pool["feeTier"]),
+        'tick_spacing': fee_tier_to_tick_spacing(int(pool["feeTier"])),
+        'token0': pool["token0"]["symbol"],
+        'token1': pool["token1"]["symbol"],
+        'decimals0': int(pool["token0"]["decimals"]),
+        'decimals1': int(pool["token1"]["decimals"]),
+    }
+
+
+def get_pool_info_and_usd_volume(client, pool_id: str, date: datetime.date) -> tuple:
+    """
+    Query the UniV3 subgraph for pool info and USD traded volume on a given date, in a single request
+    :param client: GQL client or session
+    :param pool_id: str, the pool contract's address
+    :param date: datetime.date, a date
+    :return: tuple of (dict containing the pool info, float USD volume)
+    """
+
     result_d = {}
+    volume_usd = 0
 
     try:
-        response = client.execute(gql(pool_query), variable_values={"pool_id": pool_id})
+        variables = {"pool_id": pool_id, "day_id": get_pool_day_id(pool_id, date)}
+        response = execute_query(client, _POOL_VOLUME_QUERY, variables)
         if len(response['pools']) == 0:
             print("pool not found")
             exit(-1)
 
-        pool = response['pools'][0]
-
-        result_d['current_tick'] = int(pool["tick"])
-        result_d['fee_tier'] = int(pool["feeTier"])
-        result_d['tick_spacing'] = fee_tier_to_tick_spacing(result_d['fee_tier'])
-        result_d['token0'] = pool["token0"]["symbol"]
-        result_d['token1'] = pool["token1"]["symbol"]
-        result_d['decimals0'] = int(pool["token0"]["decimals"])
-        result_d['decimals1'] = int(pool["token1"]["decimals"])
+        result_d = parse_pool_info(response['pools'][0])
+        volume_usd = float(response['poolDayDatas'][0]['volumeUSD'])
 
     except Exception as e:
 
-        print(f'Could not fetch pool details: {e}')
+        print(f'Could not fetch pool details and volume: {e}')
 
-    return result_d
+    return result_d, volume_usd
 
 
-def get_tick_mapping(client: Client, pool_id: str) -> dict:
+def get_tick_page(client, pool_id: str, min_tick: int, max_tick: int) -> list:
     """
-    Get tick mapping from a Uniswap v3 pool
-    :param client: GQL client
+    Get one page of ticks (sorted by tick index) within a tick band from a Uniswap v3 pool
+    :param client: GQL client or session
     :param pool_id: str, the V3 pool contract address
-    :return: dict, the tick mapping
+    :param min_tick: int, the band's lower bound (excluded)
+    :param max_tick: int, the band's upper bound (included)
+    :return: list, the ticks of the page
     """
 
-    tick_d = {}
-    num_skip = 0
-    try:
-        print("* Querying ticks", end='', flush=True)
-        while True:
-            print('.', end='', flush=True)
-            variables = {"num_skip": num_skip, "pool_id": pool_id}
-            response = client.execute(gql(tick_query), variable_values=variables)
-
-            if len(response["ticks"]) == 0:
-                break
-            num_skip += len(response["ticks"])
-            for item in response["ticks"]:
-                tick_d[int(item["tickIdx"])] = int(item["liquidityNet"])
+    print('.', end='', flush=True)
+    variables = {"page_size": TICK_PAGE_SIZE, "pool_id": pool_id, "min_tick": str(min_tick), "max_tick": str(max_tick)}
+    response = execute_query(client, _TICK_QUERY, variables)
 
-    except Exception as e:
+    return response["ticks"]
+
+
+def get_band_liquidity_nets(client, pool_id: str, min_tick: int, max_tick: int) -> list:
+    """
+    Get the liquidityNet of every initialized tick within a tick band from a Uniswap v3 pool
+    :param client: GQL client or session
+    :param pool_id: str, the V3 pool contract address
+    :param min_tick: int, the band's lower bound (excluded)
+    :param max_tick: int, the band's upper bound (included)
+    :return: list, the liquidityNet strings, in ascending tick order
+    """
+
+    liquidity_net_strs = []
+    while True:
+        page = get_tick_page(client, pool_id, min_tick, max_tick)
+        liquidity_net_strs.extend(item["liquidityNet"] for item in page)
+        if len(page) < TICK_PAGE_SIZE:
+            return liquidity_net_strs
 
-        print(f'Could not fetch tick mapping: {e}')
+        # Page with a cursor on the last tick index rather than with skip, which the subgraph caps at 5000
+        min_tick = int(page[-1]["tickIdx"])
 
-    print('')
 
-    return tick_d
+def get_tick_bands(tick: int, num_bands: int) -> list:
+    """
+    Split the tick interval (MIN_TICK - 1, tick] into disjoint bands, each one twice as wide as the previous one
+    :param tick: int, the highest tick
+    :param num_bands: int, number of bands
+    :return: list of (lower bound (excluded), upper bound (included)) tuples, from the highest band down
+    """
+    # Initialized ticks cluster around the current price, so the bands are narrow close to it and wide far from it
+    span = tick - (MIN_TICK - 1)
+    bounds = [tick - span * (2 ** k - 1) // (2 ** num_bands - 1) for k in range(num_bands + 1)]
 
+    return [(bounds[k + 1], bounds[k]) for k in range(num_bands) if bounds[k + 1] < bounds[k]]
 
-def get_liquidity_at_current_tick(pool_info_d: dict, tick_d: dict) -> tuple:
+
+def get_liquidity_at_tick(session: SyncClientSession, pool_id: str, tick: int) -> int:
     """
-    Iterate from min tick to current tick to find liquidity at current tick
+    Get the liquidity at a given tick of a Uniswap v3 pool, summing liquidityNet over every initialized tick up to it
+    :param session: connected GQL session, shared by the concurrent band queries
+    :param pool_id: str, the V3 pool contract address
+    :param tick: int, the tick, typically the bottom tick of the current range
+    :return: int, the liquidity at the tick
+    """
+
+    liquidity_net_strs = []
+    print("* Querying ticks", end='', flush=True)
+    try:
+        # Each band is paged on its own, so the bands are fetched concurrently and no request is wasted
+        with ThreadPoolExecutor(max_workers=TICK_QUERY_WORKERS) as executor:
+            bands = get_tick_bands(tick, TICK_QUERY_WORKERS)
+            for band_strs in executor.map(lambda band: get_band_liquidity_nets(session, pool_id, *band), bands):
+                liquidity_net_strs.extend(band_strs)
+    finally:
+        print('')
+
+    # Liquidity at a tick is the sum of liquidityNet over the ticks below it (inclusive); the subgraph only returned
+    # those (cf. tickIdx_lte in tick_query), so neither sorting, searching nor masking is needed.
+    # The sum is 0 when the tick is below or above every position, so no range check is needed either.
+    # liquidityNet is an int128 returned as a string: Python ints keep the sum exact, and beat a float64 array here.
+    return sum(map(int, liquidity_net_strs))
+
+
+def get_amounts_at_current_tick(pool_info_d: dict, liquidity: int) -> tuple:
+    """
+    Split the liquidity of the current tick range into token amounts
     :param pool_info_d: dict, containing pool info (tokens/decimals/current tick/tick spacing)
-    :param tick_d: dict, tick map with liquidity at each level
+    :param liquidity: int, liquidity in the current tick range (cf. get_liquidity_at_tick())
     :return: tuple of (token 0 liquidity, token 1 liquidity, total liquidity, price)
     """
 
@@ -154,20 +273,12 @@ def get_liquidity_at_current_tick(pool_info_d: dict, tick_d: dict) -> tuple:
     decimals0, decimals1 = pool_info_d['decimals0'], pool_info_d['decimals1']
     current_tick = pool_info_d['current_tick']
     tick_spacing = pool_info_d['tick_spacing']
+    decimals_factor = 10.0 ** (decimals1 - decimals0)
 
-    # Start from zero; if we were iterating from the current tick, would start from the pool's total liquidity
-    liquidity = 0
-
-    # Find the boundaries of the price range
-    min_tick = min(tick_d.keys())
-    max_tick = max(tick_d.keys())
-
-    # Compute the tick range. This code would work as well in Python: `current_tick // tick_spacing * tick_spacing`
-    # However, using floor() is more portable.
-    current_range_bottom_tick = math.floor(current_tick / tick_spacing) * tick_spacing
+    current_range_bottom_tick = get_range_bottom_tick(current_tick, tick_spacing)
 
     current_price = tick_to_price(current_tick)
-    adjusted_current_price = current_price / (10 ** (decimals1 - decimals0))
+    adjusted_current_price = current_price / decimals_factor
 
     # Guess the preferred way to display the price;
     # try to print most assets in terms of USD;
@@ -179,40 +290,20 @@ def get_liquidity_at_current_tick(pool_info_d: dict, tick_d: dict) -> tuple:
     else:
         invert_price = False
 
-    # Iterate over the tick map starting from the bottom
-    tick = min_tick
-    adjusted_amount0actual = 0
-    adjusted_amount1actual = 0
-    while tick <= max_tick:
-        liquidity_delta = tick_d.get(tick, 0)
-        liquidity += liquidity_delta
-
-        price = tick_to_price(tick)
-        adjusted_price = price / (10 ** (decimals1 - decimals0))
-        if invert_price:
-            adjusted_price = 1 / adjusted_price
-            tokens = "{} for {}".format(token0, token1)
-        else:
-            tokens = "{} for {}".format(token1, token0)
-
-        # Compute square roots of prices corresponding to the bottom and top ticks
-        bottom_tick = tick
-        top_tick = bottom_tick + tick_spacing
-        sa = tick_to_price(bottom_tick // 2)
-        sb = tick_to_price(top_tick // 2)
-
-        if tick == current_range_bottom_tick:
-
-            current_sqrt_price = tick_to_price(current_tick / 2)
-            amount0actual = liquidity * (sb - current_sqrt_price) / (
-                        current_sqrt_price * sb)  # eq(12) in technical note
-            amount1actual = liquidity * (current_sqrt_price - sa)  # eq(13) in technical note
-            adjusted_amount0actual = amount0actual / (10 ** decimals0)
-            adjusted_amount1actual = amount1actual / (10 ** decimals1)
-
-            break
-
-        tick += tick_spacing
+    # Compute square roots of prices corresponding to the bottom and top ticks
+    bottom_tick = current_range_bottom_tick
+    top_tick = bottom_tick + tick_spacing
+    sa = tick_to_price(bottom_tick // 2)
+    sb = tick_to_price(top_tick // 2)
+
+    # liquidity is converted to float once, by the products below, then everything stays in float: the decimals
+    # scaling factors are exact powers of ten (up to 1e22) and need no big-int-to-float conversion;
+    # sqrt prices are computed once and reused.
+    current_sqrt_price = tick_to_price(current_tick / 2)
+    amount0actual = liquidity * (sb - current_sqrt_price) / (current_sqrt_price * sb)  # eq(12) in technical note
+    amount1actual = liquidity * (current_sqrt_price - sa)  # eq(13) in technical note
+    adjusted_amount0actual = amount0actual / 10.0 ** decimals0
+    adjusted_amount1actual = amount1actual / 10.0 ** decimals1
 
     price_with_inversion = 1 / adjusted_current_price if invert_price else adjusted_current_price
 
@@ -225,21 +316,25 @@ def get_liquidity_at_current_tick(pool_info_d: dict, tick_d: dict) -> tuple:
 if __name__ == '__main__':
 
     client = Client(
-        transport=RequestsHTTPTransport(
+        transport=HTTPXTransport(
             url='https://api.thegraph.com/subgraphs/name/uniswap/uniswap-v3',
-            verify=True,
-            retries=5,
+            json_deserialize=json_loads,
+            timeout=QUERY_TIMEOUT,
+            # A single HTTP/2 connection multiplexes the concurrent tick queries
+            transport=httpx.HTTPTransport(verify=True, http2=True, retries=5),
         ))
 
-    pool_info_d = get_pool_info(client, POOL_ID)
-    print(f'* Pool={POOL_ID}, details: {pool_info_d}')
+    # A single connected session keeps one HTTP/2 connection open for all the queries
+    with client as session:
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        pool_info_d, usd_volume = get_pool_info_and_usd_volume(session, POOL_ID, yesterday)
+        print(f'* Pool={POOL_ID}, details: {pool_info_d}')
+        print(f'* Daily volume of pool for {yesterday:%Y-%m-%d}: {usd_volume:,.0f}$')
 
-    yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    usd_volume = get_usd_volume(client, POOL_ID, yesterday)
-    print(f'* Daily volume of pool for {yesterday:%Y-%m-%d}: {usd_volume:,.0f}$')
+        current_range_bottom_tick = get_range_bottom_tick(pool_info_d['current_tick'], pool_info_d['tick_spacing'])
+        current_liquidity = get_liquidity_at_tick(session, POOL_ID, current_range_bottom_tick)
 
-    tick_mapping_d = get_tick_mapping(client, POOL_ID)
-    liq_0, liq_1, liq_total, price = get_liquidity_at_current_tick(pool_info_d, tick_mapping_d)
+    liq_0, liq_1, liq_total, price = get_amounts_at_current_tick(pool_info_d, current_liquidity)
     print(f'* Current tick liquidity: {pool_info_d["token0"]}={liq_0:,.2f}, {pool_info_d["token1"]}={liq_1:,.2f}')
     print(f'* Price={price:,.2f}, total current tick liquidity={liq_total:,.2f}')
 
@@ -1,9 +1,15 @@
 
-pool_query = """query get_pools($pool_id: ID!) {
+tick_query = """query get_ticks($page_size: Int, $pool_id: ID!, $min_tick: BigInt!, $max_tick: BigInt!) {
+  ticks(first: $page_size, orderBy: tickIdx, orderDirection: asc,
+        where: {pool: $pool_id, tickIdx_gt: $min_tick, tickIdx_lte: $max_tick}) {
+    tickIdx
+    liquidityNet
+  }
+}"""
+
+pool_volume_query = """query get_pool_and_poolDayDatas($pool_id: ID!, $day_id: ID!) {
   pools(where: {id: $pool_id}) {
     tick
-    sqrtPrice
-    liquidity
     feeTier
     token0 {
       symbol
@@ -14,17 +20,7 @@ pool_query = """query get_pools($pool_id: ID!) {
       decimals
     }
   }
-}"""
-
-tick_query = """query get_ticks($num_skip: Int, $pool_id: ID!) {
-  ticks(skip: $num_skip, where: {pool: $pool_id}) {
-    tickIdx
-    liquidityNet
-  }
-}"""
-
-volume_query = """query get_poolDayDatas($id: ID!) {
-  poolDayDatas(where: {id: $id}) {
+  poolDayDatas(where: {id: $day_id}) {
     volumeUSD
   }
 }"""